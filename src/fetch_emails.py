@@ -1,9 +1,19 @@
 import base64
+import json
 import sqlite3
 import datetime
+import logging
+import random
+import time
+from logging.handlers import RotatingFileHandler
+import functools
+from email.utils import parsedate_to_datetime
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 from google.auth.transport.requests import Request
 from dotenv import load_dotenv
 import os
@@ -20,6 +30,68 @@ EMAIL_SIZE = os.getenv("EMAIL_SIZE", "50")  # Default to 50 if not set
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 CREDENTIALS_FILE = os.path.join(BASE_DIR, os.getenv("CREDENTIALS_FILE"))
 TOKENS_FILE = os.path.join(BASE_DIR, os.getenv("TOKENS_FILE"))
+RULES_FILE_PATH = os.path.join(BASE_DIR, os.getenv("RULES_FILE"))
+BATCH_SIZE = 100  # Maximum number of sub-requests Gmail allows in one batch call
+# Partial-response masks so Gmail only returns the fields that are stored
+LIST_FIELDS = 'messages/id,nextPageToken'
+MESSAGE_FIELDS = 'id,payload/headers,payload/body/data,payload/parts(mimeType,body/data)'
+METADATA_FIELDS = 'id,payload/headers'
+UTC = datetime.timezone.utc
+# Message headers copied into the database
+WANTED_HEADERS = frozenset(('Subject', 'From', 'To', 'Date'))
+HTTP_TIMEOUT = 60  # Seconds before a Gmail API socket read times out
+RETRYABLE_STATUSES = frozenset((429, 500, 502, 503, 504))  # Rate limits and transient server errors
+MAX_RETRIES = 5  # Retries per message before giving up
+RETRY_BASE_DELAY = 1  # Seconds before the first retry, doubled on each attempt
+LOG_MAX_BYTES = 1024 * 1024  # Size at which the log file is rotated
+LOG_BACKUP_COUNT = 3  # Number of rotated log files kept
+
+# SQL built once; the table name comes from the environment and is quoted as an identifier
+TABLE_SQL = '"' + TABLE_NAME.replace('"', '""') + '"'
+TABLE_INFO_SQL = f'PRAGMA table_info({TABLE_SQL})'
+DROP_TABLE_SQL = f'DROP TABLE {TABLE_SQL}'
+CREATE_TABLE_SQL = f'''
+    CREATE TABLE IF NOT EXISTS {TABLE_SQL} (
+        gmail_id TEXT PRIMARY KEY,
+        sender TEXT,
+        recipient TEXT,
+        subject TEXT,
+        message TEXT,
+        date INTEGER
+    )
+'''
+CREATE_DATE_INDEX_SQL = f'CREATE INDEX IF NOT EXISTS idx_emails_date ON {TABLE_SQL}(date)'
+DELETE_SQL = f'DELETE FROM {TABLE_SQL}'
+INSERT_SQL = (f'INSERT OR REPLACE INTO {TABLE_SQL} (gmail_id, sender, recipient, subject, message, date) '
+              'VALUES (?, ?, ?, ?, ?, ?)')
+
+# Error logger writing to LOG_FILE only
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+logger.propagate = False
+_log_handler = None
+
+# Gmail service built once per process and reused by every caller
+_SERVICE = None
+
+def get_logger():
+    """
+    Returns the module logger, attaching a rotating file handler for
+    LOG_FILE on first use. The handler keeps its file open for the life of
+    the process and is only replaced if LOG_FILE is changed.
+    """
+    log_path = os.path.abspath(LOG_FILE)
+    global _log_handler
+    if _log_handler is None or _log_handler.baseFilename != log_path:
+        if _log_handler is not None:
+            logger.removeHandler(_log_handler)
+            _log_handler.close()
+        _log_handler = RotatingFileHandler(log_path, maxBytes=LOG_MAX_BYTES,
+                                           backupCount=LOG_BACKUP_COUNT, delay=True)
+        _log_handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S'))
+        logger.addHandler(_log_handler)
+    return logger
+
 
 def log_error(message):
     """
@@ -27,24 +99,28 @@ def log_error(message):
     Args:
         message (str): The error message to log
     """
-    timestamp = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-    with open(LOG_FILE, 'a') as log_file:
-        log_file.write(f"[{timestamp}] {message}\n")
+    get_logger().error(message)
 
 
 def authenticate_gmail():
     """
     Handles authentication with the Gmail API using OAuth 2.0.
     Reuses saved credentials if available, otherwise initiates a new login flow.
+    The service is built once and cached; its authorized HTTP client keeps
+    connections alive so later requests reuse the same TCP/TLS socket.
     Returns:
         service: Authorized Gmail API service instance
     """
+    global _SERVICE
+    if _SERVICE is not None:
+        return _SERVICE
     try:
         creds = None
 
         # Load credentials from token file if it exists
         if os.path.exists(TOKENS_FILE):
             creds = Credentials.from_authorized_user_file(TOKENS_FILE, SCOPES)
+        saved_token = creds.token if creds else None
 
         # If no valid credentials, start the OAuth flow
         if not creds or not creds.valid:
@@ -56,13 +132,16 @@ def authenticate_gmail():
                 flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
                 creds = flow.run_local_server(port=0)
 
-            # Save the new credentials for future use
+        # Save the credentials for future use, only if the token changed
+        if creds.token != saved_token:
             with open(TOKENS_FILE, 'w') as token:
                 token.write(creds.to_json())
 
-        # Build and return the Gmail API service object
-        gmail_service = build('gmail', 'v1', credentials=creds)
-        return gmail_service
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+
+        # Build the Gmail API service object from the bundled discovery document
+        _SERVICE = build('gmail', 'v1', http=http, cache_discovery=True, static_discovery=True)
+        return _SERVICE
     except Exception as e:
         log_error(f"Gmail authentication failed: {e}")
         raise
@@ -78,24 +157,33 @@ def setup_database():
     """
     conn = None
     try:
-        conn = sqlite3.connect(DB_NAME)
+        # Autocommit mode: transactions are opened explicitly where needed
+        conn = sqlite3.connect(DB_NAME, isolation_level=None)
         c = conn.cursor()
 
+        # WAL lets process_emails read while fetching writes, and NORMAL
+        # sync avoids an fsync on every commit
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute("PRAGMA temp_store=MEMORY")
+        c.execute("PRAGMA mmap_size=268435456")
+        c.execute("PRAGMA cache_size=-65536")
+        c.execute("PRAGMA busy_timeout=30000")
+
+        # Drop tables from older versions that stored dates as text;
+        # their rows are cleared on every run anyway
+        columns = {row[1]: row[2] for row in c.execute(TABLE_INFO_SQL)}
+        if columns.get('date', 'INTEGER') != 'INTEGER':
+            c.execute(DROP_TABLE_SQL)
+
         # Create the Emails table if it doesn't already exist
-        c.execute(f'''
-            CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
-                gmail_id TEXT PRIMARY KEY,
-                sender TEXT,
-                recipient TEXT,
-                subject TEXT,
-                message TEXT,
-                date TEXT
-            )
-        ''')
+        c.execute(CREATE_TABLE_SQL)
+
+        # Index the date column for range rules
+        c.execute(CREATE_DATE_INDEX_SQL)
 
         # Clear previous records to refresh with latest fetched emails
-        c.execute(f'DELETE FROM {TABLE_NAME}')
-        conn.commit()
+        c.execute(DELETE_SQL)
         return conn, c
     except Exception as e:
         if conn:
@@ -104,27 +192,41 @@ def setup_database():
         raise
 
 
-def format_email_date(date_str):
+@functools.lru_cache(maxsize=4096)
+def parse_email_timestamp(date_str):
     """
-    Converts RFC 2822-style email date string to IST (UTC+5:30) formatted string.
-    Falls back to original string on parsing error.
+    Parses an RFC 2822-style email date string into a Unix timestamp.
+    Results are cached, as the same Date header often repeats within threads
+    and refetches; lru_cache doesn't cache exceptions, so failures are not.
     Args:
         date_str (str): Raw date string from email header
     Returns:
-        str: Formatted date string in 'DD/MM/YYYY HH:MM:SS' or original string on failure
+        int: Seconds since the epoch
     """
-    try:
-        # Parse the date using common RFC format, ignoring timezone info
-        date_obj = datetime.datetime.strptime(date_str[:25], '%a, %d %b %Y %H:%M:%S')
+    # Parse the full RFC 2822 date, including its timezone offset
+    date_obj = parsedate_to_datetime(date_str)
+
+    # Dates without a usable offset (e.g. '-0000') are taken as UTC
+    if date_obj.tzinfo is None:
+        date_obj = date_obj.replace(tzinfo=UTC)
+    return int(date_obj.timestamp())
 
-        # Apply IST timezone offset
-        offset = datetime.timedelta(hours=5, minutes=30)
-        ist_datetime = date_obj + offset
 
-        return ist_datetime.strftime('%d/%m/%Y %H:%M:%S')
+def format_email_date(date_str):
+    """
+    Converts RFC 2822-style email date string to a Unix timestamp, so stored
+    dates compare chronologically and can be range-queried through an index.
+    Returns None on parsing error, logging every failure.
+    Args:
+        date_str (str): Raw date string from email header
+    Returns:
+        int: Seconds since the epoch, or None on failure
+    """
+    try:
+        return parse_email_timestamp(date_str)
     except Exception as e:
         log_error(f"Date formatting failed for '{date_str}': {e}")
-        return date_str
+        return None
 
 
 def extract_message_body(payload):
@@ -143,60 +245,186 @@ def extract_message_body(payload):
 
         # Handle multi-part messages, prefer plain text
         for part in payload.get('parts', []):
-            if part['mimeType'] == 'text/plain' and 'data' in part['body']:
+            # The fields mask drops 'body' from parts that carry no inline data
+            if part.get('mimeType') == 'text/plain' and 'data' in part.get('body', {}):
                 return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
     except Exception as e:
         log_error(f"Message body extraction failed: {e}")
 
     return ''  # Fallback if message can't be decoded
 
-def fetch_emails(gmail_service, max_results):
+def rules_need_body():
+    """
+    Checks whether any rule in the rules file reads the message body, so the
+    body can be skipped entirely when none does. Assumes it is needed if the
+    rules can't be read.
+    Returns:
+        bool: True if some rule uses the 'message' field
+    """
+    try:
+        with open(RULES_FILE_PATH, 'r') as file:
+            rule_sets = json.load(file).get("all_rules", [])
+        return any(rule['field'].lower() == 'message'
+                   for rule_set in rule_sets for rule in rule_set.get('rules', []))
+    except Exception as e:
+        log_error(f"Could not read rules to check for body use: {e}")
+        return True
+
+
+def message_request_params(include_body):
+    """
+    Gmail messages().get() parameters for the stored fields.
+    Args:
+        include_body (bool): Whether the message body is needed
+    Returns:
+        dict: Full format with the body fields mask, or metadata format
+        limited to the stored headers
+    """
+    if include_body:
+        return {'format': 'full', 'fields': MESSAGE_FIELDS}
+    return {'format': 'metadata', 'metadataHeaders': sorted(WANTED_HEADERS), 'fields': METADATA_FIELDS}
+
+
+def parse_message(msg_data, include_body=True):
+    """
+    Extracts the stored fields from a Gmail API message resource.
+    Args:
+        msg_data (dict): Message resource returned by messages().get()
+        include_body (bool): Whether to decode the message body; stored as None
+            (NULL) otherwise, so it can't be mistaken for an empty body
+    Returns:
+        tuple: (gmail_id, sender, recipient, subject, message, date) row
+    """
+    payload = msg_data.get('payload', {})
+    headers = payload.get('headers', [])
+
+    message = extract_message_body(payload) if include_body else None
+    gmail_id = msg_data['id']
+
+    # Keep only the stored headers, then look each one up directly
+    header_values = {header['name']: header['value'] for header in headers
+                     if header['name'] in WANTED_HEADERS}
+    subject = header_values.get('Subject', '')
+    sender = header_values.get('From', '')
+    recipient = header_values.get('To', '')
+    date_str = header_values.get('Date', '')
+
+    formatted_date = format_email_date(date_str)
+    return gmail_id, sender, recipient, subject, message, formatted_date
+
+
+def insert_rows(cursor, rows):
+    """
+    Inserts parsed email rows in one explicit transaction with a single
+    executemany() call of the module-level INSERT statement.
+    The caller commits the transaction.
+    Args:
+        cursor: SQLite cursor object
+        rows (list of tuple): Rows as returned by parse_message
+    """
+    cursor.execute("BEGIN")
+    cursor.executemany(INSERT_SQL, rows)
+
+
+def retry_delay(attempt):
+    """
+    Exponential backoff with jitter, as recommended for Gmail rate limits.
+    Args:
+        attempt (int): Zero-based retry attempt
+    Returns:
+        float: Seconds to wait before retrying
+    """
+    return RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, 1)
+
+
+def is_retryable(exception):
+    """
+    Checks whether a failed Gmail API request is worth retrying.
+    Args:
+        exception (Exception): Error reported for the request
+    Returns:
+        bool: True for rate limit (429) and transient 5xx responses, and for
+        connection errors and timeouts
+    """
+    if isinstance(exception, HttpError):
+        return exception.resp.status in RETRYABLE_STATUSES
+    return isinstance(exception, (OSError, httplib2.HttpLib2Error))
+
+
+def fetch_emails(gmail_service, max_results, include_body=None):
     """
     Fetches emails from the Gmail inbox, extracts relevant fields,
     and stores them in a local SQLite database.
+    Message details are requested through Gmail batch requests, packing up to
+    BATCH_SIZE messages().get() calls into a single HTTP round trip.
+    Sub-requests rejected with a rate limit or transient server error, and
+    whole batch calls failing the same way, are retried in a new batch with
+    exponential backoff.
+    Bodies are only fetched when include_body is set, defaulting to whether
+    any rule reads them.
     """
     conn = None
+    if include_body is None:
+        include_body = rules_need_body()
+    get_params = message_request_params(include_body)
     try:
         conn, cursor = setup_database()
 
         results = gmail_service.users().messages().list(
-            userId='me', labelIds=['INBOX'], maxResults=max_results).execute()
+            userId='me', labelIds=['INBOX'], maxResults=max_results, fields=LIST_FIELDS).execute()
         messages = results.get('messages', [])
 
         total = len(messages)
-        for index, msg in enumerate(messages, start=1):
-            try:
-                msg_data = gmail_service.users().messages().get(userId='me', id=msg['id']).execute()
-                payload = msg_data.get('payload', {})
-                headers = payload.get('headers', [])
-
-                subject = sender = recipient = date_str = ""
-                message = extract_message_body(payload)
-                gmail_id = msg['id']
-
-                for header in headers:
-                    if header['name'] == 'Subject':
-                        subject = header['value']
-                    elif header['name'] == 'From':
-                        sender = header['value']
-                    elif header['name'] == 'To':
-                        recipient = header['value']
-                    elif header['name'] == 'Date':
-                        date_str = header['value']
-
-                formatted_date = format_email_date(date_str)
-
-                cursor.execute(f'''
-                    INSERT OR REPLACE INTO {TABLE_NAME} (
-                        gmail_id, sender, recipient, subject, message, date
-                    ) VALUES (?, ?, ?, ?, ?, ?)
-                ''', (gmail_id, sender, recipient, subject, message, formatted_date))
-
-                print(f"[✓] Fetched and stored email {index} of {total} — Subject: \"{subject}\"")
-
-            except Exception as inner_e:
-                log_error(f"Failed to process message ID {msg.get('id')}: {inner_e}")
-
+        rows = []
+        pending_ids = [msg['id'] for msg in messages]
+        attempt = 0
+
+        while pending_ids:
+            retry_ids = []
+            handled_ids = set()
+
+            def handle_msg(request_id, response, exception):
+                handled_ids.add(request_id)
+                if exception is not None:
+                    if is_retryable(exception) and attempt < MAX_RETRIES:
+                        retry_ids.append(request_id)
+                    else:
+                        log_error(f"Failed to process message ID {request_id}: {exception}")
+                    return
+                try:
+                    row = parse_message(response, include_body)
+                    rows.append(row)
+                    print(f"[✓] Fetched email {len(rows)} of {total} — Subject: \"{row[3]}\"")
+
+                except Exception as inner_e:
+                    log_error(f"Failed to process message ID {request_id}: {inner_e}")
+
+            # Gmail accepts at most BATCH_SIZE sub-requests per batch call
+            for start in range(0, len(pending_ids), BATCH_SIZE):
+                chunk_ids = pending_ids[start:start + BATCH_SIZE]
+                batch = gmail_service.new_batch_http_request(callback=handle_msg)
+                for msg_id in chunk_ids:
+                    batch.add(
+                        gmail_service.users().messages().get(userId='me', id=msg_id, **get_params),
+                        request_id=msg_id)
+                try:
+                    batch.execute()
+                except Exception as batch_e:
+                    # A failed batch call only loses its own chunk; messages
+                    # it never reported on are retried or skipped
+                    unhandled_ids = [msg_id for msg_id in chunk_ids if msg_id not in handled_ids]
+                    if is_retryable(batch_e) and attempt < MAX_RETRIES:
+                        retry_ids.extend(unhandled_ids)
+                    else:
+                        log_error(f"Failed to fetch {len(unhandled_ids)} messages in batch: {batch_e}")
+
+            # Back off before retrying rate-limited or failed sub-requests
+            if retry_ids:
+                time.sleep(retry_delay(attempt))
+                attempt += 1
+            pending_ids = retry_ids
+
+        insert_rows(cursor, rows)
         conn.commit()
         print("\n[INFO] All emails processed and stored successfully.")
 
@@ -211,4 +439,4 @@ def fetch_emails(gmail_service, max_results):
 if __name__ == '__main__':
     # Entry point: Authenticate and fetch emails
     service = authenticate_gmail()
-    fetch_emails(service , EMAIL_SIZE)
+    fetch_emails(service, EMAIL_SIZE)
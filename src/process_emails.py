@@ -1,11 +1,18 @@
 import json
 import os
+import queue
 import sqlite3
 import datetime
+import logging
+from logging.handlers import RotatingFileHandler
+from contextlib import closing, contextmanager
 from dotenv import load_dotenv
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 from google.auth.transport.requests import Request
 load_dotenv()
 
@@ -24,33 +31,149 @@ PROCESS_LOG_FILE = os.getenv("PROCESS_LOG_FILE")
 TOKENS_FILE = os.path.join(BASE_DIR, os.getenv("TOKENS_FILE"))
 
 RULES_FILE_PATH = os.path.join(BASE_DIR, os.getenv("RULES_FILE"))
+# Number of idle read connections kept open by the SQLite pool
+POOL_SIZE = 4
+# Seconds before a Gmail API socket read times out
+HTTP_TIMEOUT = 60
+# Maximum message IDs accepted by a single batchModify call
+MODIFY_BATCH_SIZE = 1000
+# Maximum sub-requests Gmail allows in one batch HTTP call
+TRASH_BATCH_SIZE = 100
+# Checks for emails stored without their message body, which is NULL when not fetched
+MISSING_BODY_SQL = "SELECT EXISTS (SELECT 1 FROM Emails WHERE message IS NULL)"
+# Email columns that rules may reference
+RULE_COLUMNS = {'sender', 'recipient', 'subject', 'message', 'date'}
+# Size at which the log file is rotated, and how many old logs are kept
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
+# Gmail system labels by lowercased name; their IDs are fixed, so no lookup is needed
+SYSTEM_LABELS = {
+    'inbox': 'INBOX',
+    'unread': 'UNREAD',
+    'starred': 'STARRED',
+    'important': 'IMPORTANT',
+    'trash': 'TRASH',
+}
+
+# Error logger writing to PROCESS_LOG_FILE only
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+logger.propagate = False
+_log_handler = None
+
+# Gmail service built once per process and reused by every caller
+_SERVICE = None
+# User label IDs by lowercased name, loaded with a single labels().list() call on first use
+_LABEL_CACHE = None
+
+
+class SqlitePool:
+    """
+    Pool of read connections to a single SQLite database.
+    Connections are opened lazily, configured once, and reused across calls
+    instead of being reopened for every query. process_emails only reads,
+    so all writes stay on the single connection used by fetch_emails.
+    """
+
+    def __init__(self, db_path, size=POOL_SIZE):
+        self.db_path = db_path
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.execute("PRAGMA query_only=ON")
+            register_rule_functions(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    @contextmanager
+    def acquire(self):
+        """
+        Yields a pooled connection and returns it to the pool afterwards.
+        Connections beyond the pool size are closed instead of kept, and a
+        connection whose caller raised is closed rather than reused.
+        """
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        """
+        Closes every idle connection held by the pool.
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+POOL = SqlitePool(EMAIL_DB_NAME)
+
+
 
+def get_logger():
+    """
+    Returns the module logger, attaching a rotating file handler for
+    PROCESS_LOG_FILE on first use. The handler keeps its file open for the life of
+    the process and is only replaced if PROCESS_LOG_FILE is changed.
+    """
+    log_path = os.path.abspath(PROCESS_LOG_FILE)
+    global _log_handler
+    if _log_handler is None or _log_handler.baseFilename != log_path:
+        if _log_handler is not None:
+            logger.removeHandler(_log_handler)
+            _log_handler.close()
+        _log_handler = RotatingFileHandler(log_path, maxBytes=LOG_MAX_BYTES,
+                                           backupCount=LOG_BACKUP_COUNT, delay=True)
+        _log_handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S'))
+        logger.addHandler(_log_handler)
+    return logger
 
 
 def log_error(message):
     """
-    Logs error messages with a timestamp to fetch_emails.log.
+    Logs error messages with a timestamp to process_emails.log.
     Args:
         message (str): The error message to log
     """
-    timestamp = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-    with open(PROCESS_LOG_FILE, 'a') as log_file:
-        log_file.write(f"[{timestamp}] {message}\n")
+    get_logger().error(message)
 
 
 def authenticate_gmail():
     """
     Authenticate with the Gmail API using OAuth 2.0.
     Reuses saved credentials if valid; otherwise initiates the OAuth flow.
+    The service is built once and cached, sharing one keep-alive HTTP client.
     Returns:
         service: Authenticated Gmail API service instance
     """
+    global _SERVICE
+    if _SERVICE is not None:
+        return _SERVICE
     try:
         creds = None
 
         # Load existing token if available
         if os.path.exists(TOKENS_FILE):
             creds = Credentials.from_authorized_user_file(TOKENS_FILE, GMAIL_SCOPES)
+        saved_token = creds.token if creds else None
 
         # If credentials are missing or invalid, refresh or start new flow
         if not creds or not creds.valid:
@@ -60,163 +183,115 @@ def authenticate_gmail():
                 flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, GMAIL_SCOPES)
                 creds = flow.run_local_server(port=0)
 
-            # Save the updated credentials for reuse
-            with open('../token.json', 'w') as token:
+        # Save the updated credentials for reuse, only if the token changed
+        if creds.token != saved_token:
+            with open(TOKENS_FILE, 'w') as token:
                 token.write(creds.to_json())
 
-        return build('gmail', 'v1', credentials=creds)
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        _SERVICE = build('gmail', 'v1', http=http, cache_discovery=True, static_discovery=True)
+        return _SERVICE
     except Exception as e:
         log_error(f"Gmail authentication failed: {e}")
         raise
 
 
 
+class CompiledRuleSet:
+    """
+    A rule set from the rules file with its match type normalized once, ready
+    to be translated into SQL by compile_ruleset_to_sql.
+    """
+
+    def __init__(self, raw):
+        self.predicate = raw.get('predicate', 'all').lower()
+        self.rules = raw.get('rules', [])
+        self.actions = raw.get('actions', [])
+        self.reads_body = any(rule['field'].lower() == 'message' for rule in self.rules)
+
+
 def load_rules():
     """
     Load rule sets from the external JSON configuration file.
     Returns:
-        List of rule dictionaries from the "All Rules" key
+        List of CompiledRuleSet objects built from the "all_rules" key
     """
     try:
         with open(RULES_FILE_PATH, 'r') as file:
             data = json.load(file)
-            return data.get("all_rules", [])
+        return [CompiledRuleSet(rule_set) for rule_set in data.get("all_rules", [])]
     except Exception as e:
         log_error(f"Error opening json: {e}")
         raise
 
 
-def match_condition(value, predicate, expected):
+def parse_time_delta(expected):
     """
-    Evaluates a single rule condition against a field's value.
-    Supports string matching and date comparisons.
+    Converts a relative time rule value into a timedelta.
     Args:
-        value (str): The actual value from the email
-        predicate (str): Type of comparison (e.g., 'contains', 'less_than')
-        expected (str): Expected value or threshold (e.g., '3_days', '2_months')
+        expected (str): Threshold such as '3_days' or '2_months'
     Returns:
-        bool: Whether the condition matches
+        datetime.timedelta: Length of the period (months approximated as 30 days)
     """
-    try:
-        value = str(value or '')  # Normalize None to empty string
-        expected = str(expected)
-
-        #print(f"[DEBUG] Matching value: '{value}' with expected: '{expected}' using predicate: '{predicate}'")
-
-        if predicate == 'contains':
-            return expected.lower() in value.lower()
-        elif predicate == 'does_not_contain':
-            return expected.lower() not in value.lower()
-        elif predicate == 'equals':
-            return value.strip().lower() == expected.strip().lower()
-        elif predicate == 'does_not_equal':
-            return value.strip().lower() != expected.strip().lower()
-        elif predicate in ['less_than', 'greater_than']:
-            try:
-                # Parse the email's date
-                email_date = datetime.datetime.strptime(value, '%d/%m/%Y %H:%M:%S')
+    amount, unit = expected.lower().split('_')
+    amount = int(amount)
 
-                # Split expected format like "3_days" or "2_months"
-                amount, unit = expected.lower().split('_')
-                amount = int(amount)
+    if unit == 'days':
+        return datetime.timedelta(days=amount)
+    elif unit == 'months':
+        return datetime.timedelta(days=amount * 30)
+    raise ValueError(f"Unsupported time unit: {unit}")
 
-                # Handle days and months (30 days approximation)
-                if unit == 'days':
-                    delta = datetime.timedelta(days=amount)
-                elif unit == 'months':
-                    delta = datetime.timedelta(days=amount * 30)
-                else:
-                    raise ValueError(f"Unsupported time unit: {unit}")
 
-                # Determine cutoff date
-                cutoff = datetime.datetime.now() - delta
-
-                return email_date > cutoff if predicate == 'less_than' else email_date < cutoff
-
-            except Exception as e:
-                #print(f"[ERROR] Date parsing error or invalid expected format: {e}")
-                return False
-
-        return False  # Unknown predicate fallback
-    except Exception as e:
-        log_error(f"Error while matching condition: {e}")
-        raise
-
-
-
-
-def evaluate_rules(email, rules):
+def apply_actions(service, msg_ids, actions):
     """
-    Evaluates a set of rules against a given email's fields.
-    Args:
-        email (dict): Email data from the database
-        rules (dict): Rule set with conditions and predicate ('all' or 'any')
-    Returns:
-        bool: True if the email matches the rule set
-    """
-    try:
-        match_type = rules.get('predicate', 'all').lower()
-        rule_results = []
-
-        #print(f"\n[INFO] Evaluating Email: {email.get('subject', '')}")
-
-        for rule in rules['rules']:
-            field = rule['field'].lower()
-            predicate = rule['predicate'].lower()
-            expected = rule['value']
-            actual_value = email.get(field, '')
-
-            result = match_condition(actual_value, predicate, expected)
-            #(f"[RULE] IF {field} {predicate} '{expected}' → VALUE: '{actual_value}' → Match: {result}")
-            rule_results.append(result)
-
-        # Combine results using logical AND / OR based on rule type
-        match = all(rule_results) if match_type == 'all' else any(rule_results)
-        if match:
-            print(f"[INFO] Rule matched for Email: {email.get('subject', '')}")
-        return match
-    except Exception as e:
-        log_error(f"Error while evaluating json: {e}")
-        raise
-
-
-
-def apply_actions(service, msg_id, actions):
-    """
-    Applies Gmail actions (e.g., move to label, mark read) to a given message.
+    Applies Gmail actions (e.g., move to label, mark read) to a group of messages.
+    Label changes from all actions are merged and sent with batchModify;
+    trashing goes through batched messages().trash() calls.
     Args:
         service: Authenticated Gmail API service instance
-        msg_id (str): Gmail message ID
+        msg_ids (list): Gmail message IDs matched by the same rule set
         actions (list): List of string-based actions to perform
     """
+    if not msg_ids:
+        return
+
+    add_labels = []
+    remove_labels = []
+    trash = False
+
+    def add_label(label_id):
+        # Later actions win over earlier ones touching the same label
+        if label_id in remove_labels:
+            remove_labels.remove(label_id)
+        if label_id not in add_labels:
+            add_labels.append(label_id)
+
+    def remove_label(label_id):
+        if label_id in add_labels:
+            add_labels.remove(label_id)
+        if label_id not in remove_labels:
+            remove_labels.append(label_id)
 
     for action in actions:
         try:
-            add_labels = []
-            remove_labels = []
             action_lower = action.lower()
 
             if action_lower == 'mark_as_read':
-                remove_labels.append('UNREAD')
-                #print(f"[ACTION] Preparing to mark as READ → Message ID: {msg_id}")
+                remove_label('UNREAD')
 
             elif action_lower == 'mark_as_unread':
-                add_labels.append('UNREAD')
-                #print(f"[ACTION] Preparing to mark as UNREAD → Message ID: {msg_id}")
+                add_label('UNREAD')
 
             elif action_lower == 'move_to:starred':
-                add_labels.append('STARRED')
-                #print(f"[ACTION] Preparing to mark as STARRED → Message ID: {msg_id}")
+                add_label('STARRED')
 
             elif action_lower == 'move_to:important':
-                add_labels.append('IMPORTANT')
-                #print(f"[ACTION] Preparing to mark as IMPORTANT → Message ID: {msg_id}")
+                add_label('IMPORTANT')
 
             elif action_lower == 'move_to:trash':
-                # Move email to trash using Gmail API
-                service.users().messages().trash(userId='me', id=msg_id).execute()
-                #print(f"[ACTION] Moved to TRASH → Message ID: {msg_id}")
-                continue  # Skip label modifications
+                # Gmail has no bulk trash endpoint, handled after label changes
+                trash = True
 
             elif action_lower.startswith('move_to:'):
                 label_name = action.split(':', 1)[1].strip()
@@ -227,40 +302,79 @@ def apply_actions(service, msg_id, actions):
 
                 # Create label if it doesn't exist
                 label_id = get_or_create_label(service, label_name)
-                add_labels.append(label_id)
-                remove_labels.append('INBOX')
-                #print(f"[ACTION] Preparing to move to label '{label_name}' → Message ID: {msg_id}")
+                add_label(label_id)
+                if label_id != 'INBOX':
+                    remove_label('INBOX')
+
+        except Exception as e:
+            log_error(f"[ERROR] Failed action '{action}' on {len(msg_ids)} messages: {e}")
+
+    # If labels need to be added/removed, send one modification request per chunk
+    if add_labels or remove_labels:
+        for start in range(0, len(msg_ids), MODIFY_BATCH_SIZE):
+            body = {'ids': msg_ids[start:start + MODIFY_BATCH_SIZE]}
+            if add_labels:
+                body['addLabelIds'] = add_labels
+            if remove_labels:
+                body['removeLabelIds'] = remove_labels
+            try:
+                service.users().messages().batchModify(userId='me', body=body).execute()
+            except HttpError as e:
+                # A cached label may have been deleted in Gmail; reload labels on next lookup
+                if e.resp.status == 404:
+                    invalidate_label_cache()
+                log_error(f"[ERROR] Failed label update on {len(body['ids'])} messages: {e}")
+            except Exception as e:
+                log_error(f"[ERROR] Failed label update on {len(body['ids'])} messages: {e}")
 
-            # If labels need to be added/removed, send modification request
-            if add_labels or remove_labels:
-                body = {}
-                if add_labels:
-                    body['addLabelIds'] = add_labels
-                if remove_labels:
-                    body['removeLabelIds'] = remove_labels
+    if trash:
+        trash_messages(service, msg_ids)
 
-                service.users().messages().modify(userId='me', id=msg_id, body=body).execute()
-                #print(f"[ACTION] Labels updated for Message ID: {msg_id} → Add: {add_labels}, Remove: {remove_labels}")
 
+def trash_messages(service, msg_ids):
+    """
+    Moves messages to trash, packing the trash() calls into Gmail batch requests.
+    Args:
+        service: Authenticated Gmail API service instance
+        msg_ids (list): Gmail message IDs to trash
+    """
+
+    def handle_trash(request_id, response, exception):
+        if exception is not None:
+            log_error(f"[ERROR] Failed action 'move_to:trash' on message {request_id}: {exception}")
+
+    for start in range(0, len(msg_ids), TRASH_BATCH_SIZE):
+        try:
+            batch = service.new_batch_http_request(callback=handle_trash)
+            for msg_id in msg_ids[start:start + TRASH_BATCH_SIZE]:
+                batch.add(service.users().messages().trash(userId='me', id=msg_id), request_id=msg_id)
+            batch.execute()
         except Exception as e:
-            log_error(f"[ERROR] Failed action '{action}' on message {msg_id}: {e}")
+            log_error(f"[ERROR] Failed action 'move_to:trash' on messages: {e}")
 
 
 def get_or_create_label(service, label_name):
     """
     Retrieves an existing label ID or creates a new label if it doesn't exist.
+    Label IDs are cached, so Gmail is asked for the label list only once.
     Args:
         service: Authenticated Gmail API service instance
         label_name (str): Name of the Gmail label
     Returns:
         str: Gmail label ID
     """
+    global _LABEL_CACHE
+    key = label_name.lower()
+    if key in SYSTEM_LABELS:
+        return SYSTEM_LABELS[key]
 
     try:
-        labels = service.users().labels().list(userId='me').execute().get('labels', [])
-        for label in labels:
-            if label['name'].lower() == label_name.lower():
-                return label['id']
+        if _LABEL_CACHE is None:
+            labels = service.users().labels().list(userId='me').execute().get('labels', [])
+            _LABEL_CACHE = {label['name'].lower(): label['id'] for label in labels}
+
+        if key in _LABEL_CACHE:
+            return _LABEL_CACHE[key]
 
         # Create a new label with standard visibility settings
         new_label = service.users().labels().create(userId='me', body={
@@ -269,35 +383,144 @@ def get_or_create_label(service, label_name):
             'messageListVisibility': 'show'
         }).execute()
         #print(f"[INFO] Created label: {label_name}")
+        _LABEL_CACHE[key] = new_label['id']
         return new_label['id']
     except Exception as e:
         log_error(f"Error while creating label: {e}")
         raise
 
 
+def invalidate_label_cache():
+    """
+    Drops cached label IDs so the next lookup reloads them from Gmail.
+    """
+    global _LABEL_CACHE
+    _LABEL_CACHE = None
+
+
+
+def rule_lower(value):
+    """
+    Lowercases a field value for the contains predicates.
+    Args:
+        value: Raw column value
+    Returns:
+        str: Lowercased value, '' for NULL
+    """
+    return str(value or '').lower()
+
+
+def rule_normalize(value):
+    """
+    Strips and lowercases a field value for the equals predicates.
+    Args:
+        value: Raw column value
+    Returns:
+        str: Normalized value, '' for NULL
+    """
+    return str(value or '').strip().lower()
+
+
+def register_rule_functions(conn):
+    """
+    Registers the Python text normalizers used by compile_ruleset_to_sql, so
+    SQL matching folds case and strips whitespace with full Unicode rules
+    instead of SQLite's ASCII-only NOCASE, LIKE and TRIM.
+    Args:
+        conn: SQLite connection object
+    """
+    conn.create_function('rule_lower', 1, rule_lower, deterministic=True)
+    conn.create_function('rule_normalize', 1, rule_normalize, deterministic=True)
+
+
+def compile_ruleset_to_sql(rule_set):
+    """
+    Translates a compiled rule set into an SQL WHERE clause over the Emails table.
+    Text comparisons go through the functions added by register_rule_functions;
+    NULL fields compare as empty strings.
+    Args:
+        rule_set (CompiledRuleSet): Rule set to translate
+    Returns:
+        tuple: (where_clause, params)
+    """
+    clauses = []
+    params = []
+
+    for rule in rule_set.rules:
+        field = rule['field'].lower()
+        predicate = rule['predicate'].lower()
+        expected = str(rule['value'])
+
+        # Unknown fields read as empty strings
+        column = field if field in RULE_COLUMNS else "''"
+
+        if predicate in ['contains', 'does_not_contain']:
+            operator = '>' if predicate == 'contains' else '='
+            clauses.append(f"instr(rule_lower({column}), ?) {operator} 0")
+            params.append(expected.lower())
+        elif predicate in ['equals', 'does_not_equal']:
+            operator = '=' if predicate == 'equals' else '<>'
+            clauses.append(f"rule_normalize({column}) {operator} ?")
+            params.append(expected.strip().lower())
+        elif predicate in ['less_than', 'greater_than']:
+            # Only the date column holds timestamps; invalid thresholds never match
+            try:
+                delta = parse_time_delta(expected)
+            except Exception as e:
+                log_error(f"Invalid date rule value '{expected}': {e}")
+                delta = None
+            if field != 'date' or delta is None:
+                clauses.append('0')
+                continue
+
+            # Stored dates are indexed Unix timestamps; NULL dates never match
+            operator = '>' if predicate == 'less_than' else '<'
+            cutoff = datetime.datetime.now() - delta
+            clauses.append(f"date {operator} ?")
+            params.append(int(cutoff.timestamp()))
+        else:
+            clauses.append('0')  # Unknown predicate fallback
+
+    if not clauses:
+        return ('1' if rule_set.predicate == 'all' else '0'), params
 
-def fetch_emails_from_db():
+    joiner = ' AND ' if rule_set.predicate == 'all' else ' OR '
+    return joiner.join(f"({clause})" for clause in clauses), params
+
+
+def fetch_matching_emails(where_clause, params):
     """
-    Fetches all emails stored in the local SQLite database.
+    Selects the emails matching an SQL WHERE clause built by compile_ruleset_to_sql.
+    Args:
+        where_clause (str): SQL condition over the Emails table
+        params (list): Values bound to the clause placeholders
     Returns:
-        list of dict: List of email records with field names
+        list of sqlite3.Row: Matching records with gmail_id and subject
     """
-    conn = None
     try:
-        conn = sqlite3.connect(EMAIL_DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM Emails")
-        columns = [desc[0] for desc in cursor.description]
-        rows = cursor.fetchall()
-        conn.close()
-
-        # Convert rows to list of dictionaries
-        return [dict(zip(columns, row)) for row in rows]
+        with POOL.acquire() as conn, closing(conn.cursor()) as cursor:
+            cursor.row_factory = sqlite3.Row
+            cursor.execute(f"SELECT gmail_id, subject FROM Emails WHERE {where_clause}", params)
+            return cursor.fetchall()
     except Exception as e:
-        log_error(f"Error while fetching emails from db: {e}")
+        log_error(f"Error while querying matching emails: {e}")
+        raise
+
+
+def bodies_missing():
+    """
+    Checks whether emails were fetched without their message bodies, which
+    fetch_emails skips when no rule read them at fetch time.
+    Returns:
+        bool: True if some stored email has no message body
+    """
+    try:
+        with POOL.acquire() as conn, closing(conn.cursor()) as cursor:
+            cursor.execute(MISSING_BODY_SQL)
+            return bool(cursor.fetchone()[0])
+    except Exception as e:
+        log_error(f"Error while checking for message bodies: {e}")
         raise
-    finally:
-        conn.close()
 
 
 def process_emails():
@@ -305,34 +528,53 @@ def process_emails():
     Main processing function:
     - Authenticates Gmail API
     - Loads rule sets
-    - Fetches emails from the local database
-    - Evaluates rules for each email
-    - Applies corresponding actions on matched messages
+    - Skips rule sets on the message body if bodies were not fetched
+    - Selects matching emails per rule set with SQL
+    - Applies corresponding actions to the messages matched by each rule set
     """
 
     try:
         service = authenticate_gmail()
         all_rule_sets = load_rules()
-        emails = fetch_emails_from_db()
-
-        for email in emails:
-            applied_any_rule = False
-
-            # Evaluate email against all rule sets
-            for rule_set in all_rule_sets:
-                if evaluate_rules(email, rule_set):
-                    #print(f"[INFO] → Rule matched. Applying actions to: {email.get('subject')}")
-                    #print(f"[DEBUG] Message ID: {email.get('gmail_id')}")
-                    apply_actions(service, email['gmail_id'], rule_set.get('actions', []))
-                    applied_any_rule = True
-                    break  # Stop evaluating further rules if one matches
-
-            #if not applied_any_rule:
-                #print(f"[INFO] → No matching rule found for: {email.get('subject')}")
+
+        # Rules on the message body can't be evaluated against bodies that
+        # were never fetched; an empty stand-in would match does_not_contain
+        skip_body_rules = any(rule_set.reads_body for rule_set in all_rule_sets) and bodies_missing()
+        if skip_body_rules:
+            log_error("Message bodies were not fetched, skipping rule sets that use the 'message' field. "
+                      "Run fetch_emails.py again to fetch them.")
+
+        # Let SQLite filter the emails per rule set and only read back the matches
+        candidates = []
+        for rule_set in all_rule_sets:
+            if skip_body_rules and rule_set.reads_body:
+                candidates.append([])
+                continue
+            rows = fetch_matching_emails(*compile_ruleset_to_sql(rule_set))
+            candidates.append([(row['gmail_id'], row['subject']) for row in rows])
+
+        # Each email only gets the actions of the first rule set it matches
+        matched_ids = []
+        claimed = set()
+        for rule_set_candidates in candidates:
+            msg_ids = []
+            for gmail_id, subject in rule_set_candidates:
+                if gmail_id not in claimed:
+                    print(f"[INFO] Rule matched for Email: {subject}")
+                    claimed.add(gmail_id)
+                    msg_ids.append(gmail_id)
+            matched_ids.append(msg_ids)
+
+        # Apply each rule set's actions to all of its messages at once
+        for rule_set, msg_ids in zip(all_rule_sets, matched_ids):
+            apply_actions(service, msg_ids, rule_set.actions)
     except Exception as e:
         log_error(f"Error while processing emails: {e}")
         raise
 
 
 if __name__ == '__main__':
-    process_emails()
+    try:
+        process_emails()
+    finally:
+        POOL.close_all()
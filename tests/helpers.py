@@ -0,0 +1,16 @@
+from unittest.mock import MagicMock
+
+
+def install_fake_batch(mock_service):
+    """
+    Makes mock_service.new_batch_http_request() return batches that execute
+    each added request immediately and hand the result to the batch callback.
+    """
+    def new_batch_http_request(callback=None):
+        added = []
+        batch = MagicMock()
+        batch.add.side_effect = lambda request, callback=None, request_id=None: added.append((request_id, request))
+        batch.execute.side_effect = lambda: [callback(request_id, request.execute(), None) for request_id, request in added]
+        return batch
+
+    mock_service.new_batch_http_request.side_effect = new_batch_http_request
@@ -8,6 +8,7 @@ import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
 import src.fetch_emails as fetch_emails
 import src.process_emails as process_emails
+from tests.helpers import install_fake_batch
 
 class IntegrationTestEmailProcessing(unittest.TestCase):
     DB_NAME = 'IntegrationTestEmailDatabase.db'
@@ -15,13 +16,21 @@ class IntegrationTestEmailProcessing(unittest.TestCase):
     LOG_FILE = 'integration_test.log'
 
     def setUp(self):
+        # Remember the module settings replaced below, restored in tearDown
+        self.saved_settings = [
+            (fetch_emails, name, getattr(fetch_emails, name))
+            for name in ('DB_NAME', 'LOG_FILE')
+        ] + [
+            (process_emails, name, getattr(process_emails, name))
+            for name in ('EMAIL_DB_NAME', 'POOL', 'PROCESS_LOG_FILE', 'RULES_FILE_PATH')
+        ]
         # Setup test DB and rules file
         fetch_emails.DB_NAME = self.DB_NAME
-        fetch_emails.TABLE_NAME = 'Emails'
         fetch_emails.LOG_FILE = self.LOG_FILE
-        process_emails.DB_NAME = self.DB_NAME
-        process_emails.LOG_FILE = self.LOG_FILE
-        process_emails.RULES_FILE = self.RULES_FILE
+        process_emails.EMAIL_DB_NAME = self.DB_NAME
+        process_emails.POOL = process_emails.SqlitePool(self.DB_NAME)
+        process_emails.PROCESS_LOG_FILE = self.LOG_FILE
+        process_emails.RULES_FILE_PATH = self.RULES_FILE
         if os.path.exists(self.DB_NAME):
             os.remove(self.DB_NAME)
         if os.path.exists(self.LOG_FILE):
@@ -43,6 +52,9 @@ class IntegrationTestEmailProcessing(unittest.TestCase):
             json.dump(rules, f)
 
     def tearDown(self):
+        process_emails.POOL.close_all()
+        for module, name, value in self.saved_settings:
+            setattr(module, name, value)
         if os.path.exists(self.DB_NAME):
             os.remove(self.DB_NAME)
         if os.path.exists(self.RULES_FILE):
@@ -55,6 +67,7 @@ class IntegrationTestEmailProcessing(unittest.TestCase):
         # Mock Gmail API service
         mock_service = MagicMock()
         mock_auth.return_value = mock_service
+        install_fake_batch(mock_service)
         mock_service.users().messages().list().execute.return_value = {
             'messages': [{'id': '1'}]
         }
@@ -74,7 +87,7 @@ class IntegrationTestEmailProcessing(unittest.TestCase):
         # Check DB
         conn = sqlite3.connect(self.DB_NAME)
         c = conn.cursor()
-        c.execute('SELECT * FROM Emails')
+        c.execute(f'SELECT * FROM {fetch_emails.TABLE_SQL}')
         rows = c.fetchall()
         self.assertEqual(len(rows), 1)
         self.assertEqual(rows[0][1], 'test@domain.com')
@@ -91,22 +104,58 @@ class IntegrationTestEmailProcessing(unittest.TestCase):
             recipient TEXT,
             subject TEXT,
             message TEXT,
-            date TEXT
+            date INTEGER
         )''')
         c.execute('''INSERT INTO Emails (gmail_id, sender, recipient, subject, message, date) VALUES (?, ?, ?, ?, ?, ?)''',
-                  ('1', 'test@domain.com', 'b@c.com', 'Integration Test', 'body', '26/06/2024 16:00:00'))
+                  ('1', 'test@domain.com', 'b@c.com', 'Integration Test', 'body', 1719397800))
         conn.commit()
         conn.close()
         # Mock Gmail API service
         mock_service = MagicMock()
         mock_auth.return_value = mock_service
         # Patch Gmail API mark as read
-        mock_service.users().messages().modify.return_value.execute.return_value = {}
-        # Patch fetch_emails_from_db to use our DB
-        with patch('src.process_emails.fetch_emails_from_db', wraps=process_emails.fetch_emails_from_db):
-            process_emails.process_emails()
-        # Check that mark as read was called
-        self.assertTrue(mock_service.users().messages().modify.called)
+        mock_service.users().messages().batchModify.return_value.execute.return_value = {}
+        process_emails.process_emails()
+        # Check that mark as read was sent as one batched modification
+        mock_service.users().messages().batchModify.assert_called_with(
+            userId='me', body={'ids': ['1'], 'removeLabelIds': ['UNREAD']})
+
+    @patch('src.process_emails.authenticate_gmail')
+    def test_process_emails_skips_body_rules_without_bodies(self, mock_auth):
+        # Store an email fetched without its body, as fetch_emails does when no rule read it
+        conn, c = fetch_emails.setup_database()
+        fetch_emails.insert_rows(c, [('1', 'test@domain.com', 'b@c.com', 'Integration Test', None, 1719397800)])
+        conn.commit()
+        conn.close()
+        rules = {
+            "all_rules": [
+                {
+                    "predicate": "All",
+                    "rules": [
+                        {"field": "message", "predicate": "does_not_contain", "value": "keep"}
+                    ],
+                    "actions": ["move_to:trash"]
+                },
+                {
+                    "predicate": "All",
+                    "rules": [
+                        {"field": "sender", "predicate": "contains", "value": "test@domain.com"}
+                    ],
+                    "actions": ["mark_as_read"]
+                }
+            ]
+        }
+        with open(self.RULES_FILE, 'w') as f:
+            json.dump(rules, f)
+        mock_service = MagicMock()
+        mock_auth.return_value = mock_service
+        process_emails.process_emails()
+        # The body rule set was skipped, so the email falls through to the sender rule
+        self.assertFalse(mock_service.new_batch_http_request.called)
+        mock_service.users().messages().batchModify.assert_called_with(
+            userId='me', body={'ids': ['1'], 'removeLabelIds': ['UNREAD']})
+        with open(self.LOG_FILE, 'r') as f:
+            self.assertIn("skipping rule sets that use the 'message' field", f.read())
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,17 +3,20 @@ from unittest.mock import patch, MagicMock
 import os
 import sys
 import base64
+import datetime
+import sqlite3
 
 import src.fetch_emails as fetch_emails
+import src.process_emails as process_emails
+from tests.helpers import install_fake_batch
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
 
+
 class TestFetchEmails(unittest.TestCase):
     def setUp(self):
         self.db_name = 'TestEmailDatabase.db'
-        self.table_name = 'Emails'
         fetch_emails.DB_NAME = self.db_name
-        fetch_emails.TABLE_NAME = self.table_name
         # Remove test DB if exists
         if os.path.exists(self.db_name):
             os.remove(self.db_name)
@@ -26,28 +29,63 @@ class TestFetchEmails(unittest.TestCase):
         log_file = 'test_fetch_emails.log'
         if os.path.exists(log_file):
             os.remove(log_file)
+        original_log_file = fetch_emails.LOG_FILE
         fetch_emails.LOG_FILE = log_file
-        fetch_emails.log_error('Test error message')
-        with open(log_file, 'r') as f:
-            content = f.read()
-        self.assertIn('Test error message', content)
-        os.remove(log_file)
+        try:
+            fetch_emails.log_error('Test error message')
+            with open(log_file, 'r') as f:
+                content = f.read()
+            self.assertIn('Test error message', content)
+        finally:
+            fetch_emails.LOG_FILE = original_log_file
+            os.remove(log_file)
 
     def test_setup_database_creates_table(self):
         conn, c = fetch_emails.setup_database()
-        c.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{self.table_name}'")
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (fetch_emails.TABLE_NAME,))
         self.assertIsNotNone(c.fetchone())
         conn.close()
 
+    def test_setup_database_migrates_text_dates(self):
+        conn = sqlite3.connect(self.db_name)
+        conn.execute(f"CREATE TABLE {fetch_emails.TABLE_SQL} (gmail_id TEXT PRIMARY KEY, date TEXT)")
+        conn.close()
+        conn, c = fetch_emails.setup_database()
+        columns = {row[1]: row[2] for row in c.execute(f"PRAGMA table_info({fetch_emails.TABLE_SQL})")}
+        self.assertEqual(columns['date'], 'INTEGER')
+        conn.close()
+
+    def test_setup_database_indexes_date_only(self):
+        conn, c = fetch_emails.setup_database()
+        indexes = [row[1] for row in c.execute(f"PRAGMA index_list({fetch_emails.TABLE_SQL})") if row[3] == 'c']
+        self.assertEqual(indexes, ['idx_emails_date'])
+        conn.close()
+
+    def test_setup_database_enables_wal(self):
+        conn, c = fetch_emails.setup_database()
+        c.execute("PRAGMA journal_mode")
+        self.assertEqual(c.fetchone()[0], 'wal')
+        self.assertIsNone(conn.isolation_level)
+        conn.close()
+
     def test_format_email_date_valid(self):
         date_str = 'Wed, 26 Jun 2024 10:30:00 +0000'
         formatted = fetch_emails.format_email_date(date_str)
-        self.assertEqual(formatted, '26/06/2024 16:00:00')
+        self.assertEqual(formatted, 1719397800)
 
-    def test_format_email_date_invalid(self):
+    def test_format_email_date_timezone(self):
+        self.assertEqual(fetch_emails.format_email_date('Wed, 26 Jun 2024 05:30:00 -0500'), 1719397800)
+        self.assertEqual(fetch_emails.format_email_date('Wed, 26 Jun 2024 10:30:00 -0000'), 1719397800)
+        self.assertEqual(fetch_emails.format_email_date('Wed, 26 Jun 2024 16:00:00 +0530 (IST)'), 1719397800)
+
+    @patch('src.fetch_emails.log_error')
+    def test_format_email_date_invalid(self, mock_log):
         date_str = 'invalid-date-string'
         formatted = fetch_emails.format_email_date(date_str)
-        self.assertEqual(formatted, date_str)
+        self.assertIsNone(formatted)
+        # Failures aren't cached, so a repeated bad header is logged again
+        self.assertIsNone(fetch_emails.format_email_date(date_str))
+        self.assertEqual(mock_log.call_count, 2)
 
     def test_extract_message_body_single(self):
         payload = {'body': {'data': base64.urlsafe_b64encode(b'hello').decode('utf-8')}}
@@ -63,6 +101,41 @@ class TestFetchEmails(unittest.TestCase):
         result = fetch_emails.extract_message_body(payload)
         self.assertEqual(result, 'world')
 
+    def test_rules_need_body(self):
+        rules_file = 'test_rules.json'
+        original_rules_path = fetch_emails.RULES_FILE_PATH
+        fetch_emails.RULES_FILE_PATH = rules_file
+        try:
+            with open(rules_file, 'w') as f:
+                f.write('{"all_rules": [{"rules": [{"field": "Message", "predicate": "contains", "value": "x"}]}]}')
+            self.assertTrue(fetch_emails.rules_need_body())
+            with open(rules_file, 'w') as f:
+                f.write('{"all_rules": [{"rules": [{"field": "subject", "predicate": "contains", "value": "x"}]}]}')
+            self.assertFalse(fetch_emails.rules_need_body())
+        finally:
+            fetch_emails.RULES_FILE_PATH = original_rules_path
+            os.remove(rules_file)
+
+    @patch('src.fetch_emails.setup_database')
+    def test_fetch_emails_skips_body(self, mock_setup_db):
+        mock_service = MagicMock()
+        mock_cursor = MagicMock()
+        mock_setup_db.return_value = (MagicMock(), mock_cursor)
+        install_fake_batch(mock_service)
+        mock_service.users().messages().list().execute.return_value = {'messages': [{'id': '1'}]}
+        mock_service.users().messages().get().execute.return_value = {
+            'id': '1',
+            'payload': {
+                'headers': [{'name': 'Date', 'value': 'Wed, 26 Jun 2024 10:30:00 +0000'}],
+                'body': {'data': base64.urlsafe_b64encode(b'body').decode('utf-8')}
+            }
+        }
+        fetch_emails.fetch_emails(mock_service, max_results=1, include_body=False)
+        mock_service.users().messages().get.assert_called_with(
+            userId='me', id='1', format='metadata',
+            metadataHeaders=['Date', 'From', 'Subject', 'To'], fields='id,payload/headers')
+        self.assertIsNone(mock_cursor.executemany.call_args[0][1][0][4])
+
     @patch('src.fetch_emails.authenticate_gmail')
     @patch('src.fetch_emails.setup_database')
     def test_fetch_emails_handles_api(self, mock_setup_db, mock_auth):
@@ -72,6 +145,7 @@ class TestFetchEmails(unittest.TestCase):
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
         mock_setup_db.return_value = (mock_conn, mock_cursor)
+        install_fake_batch(mock_service)
         mock_service.users().messages().list().execute.return_value = {
             'messages': [{'id': '1'}]
         }
@@ -88,8 +162,306 @@ class TestFetchEmails(unittest.TestCase):
             }
         }
         fetch_emails.fetch_emails(mock_service, max_results=1)
-        self.assertTrue(mock_cursor.execute.called)
+        self.assertEqual(len(mock_cursor.executemany.call_args[0][1]), 1)
+        self.assertTrue(mock_conn.commit.called)
+        self.assertEqual(mock_service.new_batch_http_request.call_count, 1)
+
+    @patch('src.fetch_emails.setup_database')
+    def test_fetch_emails_chunks_batches(self, mock_setup_db):
+        mock_service = MagicMock()
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_setup_db.return_value = (mock_conn, mock_cursor)
+        install_fake_batch(mock_service)
+        mock_service.users().messages().list().execute.return_value = {
+            'messages': [{'id': str(i)} for i in range(150)]
+        }
+        mock_service.users().messages().get().execute.return_value = {
+            'id': '1',
+            'payload': {'headers': [{'name': 'Subject', 'value': 'Test'},
+                                    {'name': 'Date', 'value': 'Wed, 26 Jun 2024 10:30:00 +0000'}]}
+        }
+        fetch_emails.fetch_emails(mock_service, max_results=150)
+        self.assertEqual(mock_service.new_batch_http_request.call_count, 2)
+        self.assertEqual(mock_cursor.executemany.call_count, 1)
+        self.assertEqual(len(mock_cursor.executemany.call_args[0][1]), 150)
+
+    @patch('src.fetch_emails.time.sleep')
+    @patch('src.fetch_emails.setup_database')
+    def test_fetch_emails_retries_rate_limited(self, mock_setup_db, mock_sleep):
+        mock_service = MagicMock()
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_setup_db.return_value = (mock_conn, mock_cursor)
+        mock_service.users().messages().list().execute.return_value = {
+            'messages': [{'id': '1'}, {'id': '2'}]
+        }
+        response = {
+            'id': '1',
+            'payload': {'headers': [{'name': 'Date', 'value': 'Wed, 26 Jun 2024 10:30:00 +0000'}]}
+        }
+        rate_limited = fetch_emails.HttpError(fetch_emails.httplib2.Response({'status': 429}), b'')
+        attempts = []
+
+        def new_batch_http_request(callback=None):
+            added = []
+            batch = MagicMock()
+            batch.add.side_effect = lambda request, callback=None, request_id=None: added.append(request_id)
+
+            def execute():
+                for request_id in added:
+                    attempts.append(request_id)
+                    if request_id == '2' and attempts.count('2') == 1:
+                        callback(request_id, None, rate_limited)
+                    else:
+                        callback(request_id, response, None)
+            batch.execute.side_effect = execute
+            return batch
+
+        mock_service.new_batch_http_request.side_effect = new_batch_http_request
+        fetch_emails.fetch_emails(mock_service, max_results=2, include_body=False)
+        self.assertEqual(attempts, ['1', '2', '2'])
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertEqual(len(mock_cursor.executemany.call_args[0][1]), 2)
+
+    @patch('src.fetch_emails.log_error')
+    @patch('src.fetch_emails.time.sleep')
+    @patch('src.fetch_emails.setup_database')
+    def test_fetch_emails_survives_failed_batch(self, mock_setup_db, mock_sleep, mock_log):
+        mock_service = MagicMock()
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_setup_db.return_value = (mock_conn, mock_cursor)
+        mock_service.users().messages().list().execute.return_value = {
+            'messages': [{'id': str(i)} for i in range(150)]
+        }
+        response = {
+            'id': '1',
+            'payload': {'headers': [{'name': 'Date', 'value': 'Wed, 26 Jun 2024 10:30:00 +0000'}]}
+        }
+        forbidden = fetch_emails.HttpError(fetch_emails.httplib2.Response({'status': 403}), b'')
+        batch_calls = []
+
+        def new_batch_http_request(callback=None):
+            added = []
+            batch = MagicMock()
+            batch.add.side_effect = lambda request, callback=None, request_id=None: added.append(request_id)
+
+            def execute():
+                batch_calls.append(len(added))
+                # The first chunk is rejected outright, the second times out once
+                if added[0] == '0':
+                    raise forbidden
+                if batch_calls.count(50) == 1:
+                    raise TimeoutError('timed out')
+                for request_id in added:
+                    callback(request_id, response, None)
+            batch.execute.side_effect = execute
+            return batch
+
+        mock_service.new_batch_http_request.side_effect = new_batch_http_request
+        fetch_emails.fetch_emails(mock_service, max_results=150, include_body=False)
+        self.assertEqual(batch_calls, [100, 50, 50])
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertEqual(len(mock_cursor.executemany.call_args[0][1]), 50)
         self.assertTrue(mock_conn.commit.called)
+        mock_log.assert_called_once()
+
+class TestAuthenticateGmail(unittest.TestCase):
+    TOKEN_FILE = 'test_token.json'
+    MODULES = (fetch_emails, process_emails)
+
+    def setUp(self):
+        self.saved_token_files = [module.TOKENS_FILE for module in self.MODULES]
+        for module in self.MODULES:
+            module.TOKENS_FILE = self.TOKEN_FILE
+            module._SERVICE = None
+
+    def tearDown(self):
+        for module, token_file in zip(self.MODULES, self.saved_token_files):
+            module.TOKENS_FILE = token_file
+            module._SERVICE = None
+        if os.path.exists(self.TOKEN_FILE):
+            os.remove(self.TOKEN_FILE)
+
+    def authenticate(self, module, creds):
+        # Every call starts from the same saved token and no cached service
+        with open(self.TOKEN_FILE, 'w') as f:
+            f.write('{"token": "saved"}')
+        module._SERVICE = None
+        with patch.object(module.Credentials, 'from_authorized_user_file', return_value=creds), \
+                patch.object(module, 'build') as mock_build:
+            first = module.authenticate_gmail()
+            second = module.authenticate_gmail()
+        return first, second, mock_build
+
+    def read_token_file(self):
+        with open(self.TOKEN_FILE, 'r') as f:
+            return f.read()
+
+    def test_authenticate_gmail_caches_service(self):
+        for module in self.MODULES:
+            with self.subTest(module=module.__name__):
+                creds = MagicMock(valid=True, token='saved')
+                first, second, mock_build = self.authenticate(module, creds)
+                self.assertIs(first, second)
+                mock_build.assert_called_once()
+
+    def test_authenticate_gmail_keeps_unchanged_token(self):
+        for module in self.MODULES:
+            with self.subTest(module=module.__name__):
+                creds = MagicMock(valid=True, token='saved')
+                self.authenticate(module, creds)
+                self.assertFalse(creds.to_json.called)
+                self.assertEqual(self.read_token_file(), '{"token": "saved"}')
+
+    def test_authenticate_gmail_saves_refreshed_token(self):
+        for module in self.MODULES:
+            with self.subTest(module=module.__name__):
+                creds = MagicMock(valid=False, expired=True, refresh_token='refresh', token='saved')
+                creds.refresh.side_effect = lambda request: setattr(creds, 'token', 'refreshed')
+                creds.to_json.return_value = '{"token": "refreshed"}'
+                self.authenticate(module, creds)
+                creds.refresh.assert_called_once()
+                self.assertEqual(self.read_token_file(), '{"token": "refreshed"}')
+
+
+class TestProcessEmails(unittest.TestCase):
+    def setUp(self):
+        process_emails.invalidate_label_cache()
+
+    def tearDown(self):
+        process_emails.invalidate_label_cache()
+
+    def test_get_or_create_label_caches_list(self):
+        mock_service = MagicMock()
+        mock_service.users().labels().list().execute.return_value = {
+            'labels': [{'name': 'Invoices', 'id': 'Label_1'}]
+        }
+        self.assertEqual(process_emails.get_or_create_label(mock_service, 'invoices'), 'Label_1')
+        self.assertEqual(process_emails.get_or_create_label(mock_service, 'Invoices'), 'Label_1')
+        mock_service.users().labels().list().execute.assert_called_once()
+
+    def test_get_or_create_label_creates_missing(self):
+        mock_service = MagicMock()
+        mock_service.users().labels().list().execute.return_value = {'labels': []}
+        mock_service.users().labels().create().execute.return_value = {'id': 'Label_2'}
+        self.assertEqual(process_emails.get_or_create_label(mock_service, 'Reports'), 'Label_2')
+        self.assertEqual(process_emails.get_or_create_label(mock_service, 'Reports'), 'Label_2')
+        mock_service.users().labels().create().execute.assert_called_once()
+
+    def test_get_or_create_label_system_label(self):
+        mock_service = MagicMock()
+        self.assertEqual(process_emails.get_or_create_label(mock_service, 'Starred'), 'STARRED')
+        self.assertFalse(mock_service.users().labels().list().execute.called)
+
+    def test_apply_actions_batches_labels(self):
+        mock_service = MagicMock()
+        msg_ids = [str(i) for i in range(1500)]
+        process_emails.apply_actions(mock_service, msg_ids, ['mark_as_read', 'move_to:starred'])
+        calls = mock_service.users().messages().batchModify.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(calls[0].kwargs['body']['ids']), 1000)
+        self.assertEqual(calls[1].kwargs['body'], {
+            'ids': msg_ids[1000:], 'addLabelIds': ['STARRED'], 'removeLabelIds': ['UNREAD']})
+
+    def test_apply_actions_trash_uses_batch(self):
+        mock_service = MagicMock()
+        install_fake_batch(mock_service)
+        process_emails.apply_actions(mock_service, ['1', '2'], ['move_to:trash'])
+        self.assertEqual(mock_service.new_batch_http_request.call_count, 1)
+        self.assertFalse(mock_service.users().messages().batchModify.called)
+
+    def test_compile_ruleset_to_sql_invalid_date(self):
+        rule_set = process_emails.CompiledRuleSet({'predicate': 'any', 'rules': [
+            {'field': 'date', 'predicate': 'less_than', 'value': '2_weeks'}]})
+        with patch('src.process_emails.log_error') as mock_log:
+            self.assertEqual(process_emails.compile_ruleset_to_sql(rule_set), ('(0)', []))
+            self.assertTrue(mock_log.called)
+
+    def test_compile_ruleset_to_sql_matches_reference(self):
+        now = datetime.datetime.now()
+        emails = [
+            {'gmail_id': '1', 'sender': 'a@Domain.com', 'subject': ' Invoice ', 'recipient': None,
+             'date': int((now - datetime.timedelta(days=1)).timestamp())},
+            {'gmail_id': '2', 'sender': 'b@other.com', 'subject': '50%_off', 'recipient': 'x@y.com',
+             'date': int((now - datetime.timedelta(days=40)).timestamp())},
+            {'gmail_id': '3', 'sender': 'c@domain.com', 'subject': 'invoice', 'recipient': '',
+             'date': None},
+            {'gmail_id': '4', 'sender': 'd@DOMAIN.com', 'subject': 'Invoice\xa0', 'recipient': 'ÄMIL@résumé.com',
+             'date': None},
+            {'gmail_id': '5', 'sender': 'e@other.com', 'subject': 'ÜNÏCODE Invoice', 'recipient': 'émil@résumé.com',
+             'date': None},
+        ]
+        conn = sqlite3.connect(':memory:')
+        process_emails.register_rule_functions(conn)
+        conn.execute('CREATE TABLE Emails (gmail_id TEXT, sender TEXT, recipient TEXT, subject TEXT, message TEXT, date INTEGER)')
+        conn.executemany('INSERT INTO Emails VALUES (:gmail_id, :sender, :recipient, :subject, NULL, :date)', emails)
+        rule_sets = [
+            {'predicate': 'all', 'rules': [
+                {'field': 'sender', 'predicate': 'contains', 'value': 'domain.COM'},
+                {'field': 'subject', 'predicate': 'equals', 'value': 'invoice'}]},
+            {'predicate': 'any', 'rules': [
+                {'field': 'subject', 'predicate': 'contains', 'value': '%_'},
+                {'field': 'date', 'predicate': 'less_than', 'value': '2_days'}]},
+            {'predicate': 'all', 'rules': [
+                {'field': 'date', 'predicate': 'greater_than', 'value': '1_months'},
+                {'field': 'recipient', 'predicate': 'does_not_equal', 'value': ''}]},
+            {'predicate': 'all', 'rules': [
+                {'field': 'recipient', 'predicate': 'does_not_contain', 'value': 'y.com'},
+                {'field': 'unknown', 'predicate': 'equals', 'value': ''}]},
+            {'predicate': 'any', 'rules': [
+                {'field': 'subject', 'predicate': 'contains', 'value': 'ünïcode'},
+                {'field': 'recipient', 'predicate': 'equals', 'value': 'Ämil@RÉSUMÉ.com'}]},
+            {'predicate': 'all', 'rules': [
+                {'field': 'recipient', 'predicate': 'does_not_equal', 'value': 'émil@résumé.com'},
+                {'field': 'subject', 'predicate': 'equals', 'value': 'invoice'}]},
+        ]
+
+        def rule_matches(email, rule):
+            # Reference semantics of a single rule, evaluated in Python
+            value = email.get(rule['field'].lower())
+            text = str(value or '')
+            expected = str(rule['value'])
+            predicate = rule['predicate'].lower()
+            if predicate == 'contains':
+                return expected.lower() in text.lower()
+            if predicate == 'does_not_contain':
+                return expected.lower() not in text.lower()
+            if predicate == 'equals':
+                return text.strip().lower() == expected.strip().lower()
+            if predicate == 'does_not_equal':
+                return text.strip().lower() != expected.strip().lower()
+            if value is None:
+                return False
+            cutoff = (now - process_emails.parse_time_delta(expected)).timestamp()
+            return value > cutoff if predicate == 'less_than' else value < cutoff
+
+        for raw in rule_sets:
+            rule_set = process_emails.CompiledRuleSet(raw)
+            where, params = process_emails.compile_ruleset_to_sql(rule_set)
+            sql_ids = sorted(row[0] for row in conn.execute(f'SELECT gmail_id FROM Emails WHERE {where}', params))
+            combine = all if rule_set.predicate == 'all' else any
+            python_ids = sorted(e['gmail_id'] for e in emails
+                                if combine(rule_matches(e, rule) for rule in rule_set.rules))
+            self.assertEqual(sql_ids, python_ids, raw)
+        conn.close()
+
+    def test_sqlite_pool_reuses_and_discards(self):
+        pool = process_emails.SqlitePool(':memory:', size=1)
+        with pool.acquire() as conn:
+            first = conn
+        with pool.acquire() as conn:
+            self.assertIs(conn, first)
+        with self.assertRaises(sqlite3.OperationalError):
+            with pool.acquire() as conn:
+                conn.execute('SELECT * FROM missing_table')
+        # The failed connection was closed, not returned to the pool
+        with self.assertRaises(sqlite3.ProgrammingError):
+            first.execute('SELECT 1')
+        with pool.acquire() as conn:
+            self.assertIsNot(conn, first)
+        pool.close_all()
 
 if __name__ == '__main__':
     unittest.main()